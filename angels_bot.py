@@ -1,14 +1,33 @@
 import os
 import sqlite3
+import argparse
+import hmac
+import hashlib
+import tempfile
+import shutil
+import signal
+import queue
+import multiprocessing
+import threading
+import traceback
 import logging
 import random
 import asyncio
 import aiohttp
 import json
+import math
+import sys
+import time
+from array import array
+from collections import Counter, OrderedDict, deque, namedtuple
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, PreCheckoutQueryHandler, ContextTypes, filters
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, PreCheckoutQueryHandler, TypeHandler, ContextTypes, filters
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest
+from pathlib import Path
 import re
 
 logging.basicConfig(
@@ -21,11 +40,79 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 PAYMENT_TOKEN = "2051251535:TEST:OTk5MDA4ODgxLTAwNQ"
 DATABASE_PATH = 'angels_bot.db'
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '10'))
+SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', '4'))
+
+# Più processi: il supervisore riceve gli aggiornamenti e li smista per user_id
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '1000'))
+WORKER_DRAIN_SECONDS = float(os.getenv('WORKER_DRAIN_SECONDS', '30'))
+
+# Registrazione del traffico reale (anonimizzato) per il replay offline; vuoto = disattivata
+TRAFFIC_CAPTURE_PATH = os.getenv('TRAFFIC_CAPTURE_PATH')
+TRAFFIC_CAPTURE_SALT = os.getenv('TRAFFIC_CAPTURE_SALT')
+
+# Messaggio giornaliero: ora di invio, limite broadcast Telegram (~30 msg/s)
+DAILY_GUIDANCE_HOUR = int(os.getenv('DAILY_GUIDANCE_HOUR', '9'))
+DAILY_GUIDANCE_RATE = float(os.getenv('DAILY_GUIDANCE_RATE', '20'))
+DAILY_GUIDANCE_PAGE_SIZE = int(os.getenv('DAILY_GUIDANCE_PAGE_SIZE', '500'))
+DAILY_GUIDANCE_CHECKPOINT_EVERY = int(os.getenv('DAILY_GUIDANCE_CHECKPOINT_EVERY', '50'))
+DAILY_GUIDANCE_RETRY_SECONDS = int(os.getenv('DAILY_GUIDANCE_RETRY_SECONDS', '300'))
+
+# Coda di invio verso Telegram: limite globale, limite per chat, tentativi dopo un 429
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '4'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+OUTBOUND_METRICS_INTERVAL = int(os.getenv('OUTBOUND_METRICS_INTERVAL', '60'))
+
+# Metriche di OpenAI, aggiornamenti e indice risposte nei log ogni METRICS_INTERVAL secondi; 0 = mai
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', '60'))
+
+# Aggiornamenti in parallelo: quanti handler insieme, quanti in attesa al massimo
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '4096'))
+
+# Raggruppamento domande verso OpenAI (0 = disattivato)
+OPENAI_BATCH_WINDOW_MS = int(os.getenv('OPENAI_BATCH_WINDOW_MS', '0'))
+OPENAI_BATCH_MAX_SIZE = int(os.getenv('OPENAI_BATCH_MAX_SIZE', '8'))
+
+# Circuit breaker OpenAI: dopo troppi errori si usano subito le risposte di riserva
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '15'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_ERROR_RATE = float(os.getenv('CIRCUIT_ERROR_RATE', '0.5'))
+CIRCUIT_WINDOW = int(os.getenv('CIRCUIT_WINDOW', '20'))
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv('CIRCUIT_HALF_OPEN_PROBES', '2'))
+
+# Indice delle risposte AI passate, usato quando l'AI viene saltata
+ANSWER_INDEX_MAX_DOCS = int(os.getenv('ANSWER_INDEX_MAX_DOCS', '5000'))
+ANSWER_INDEX_REFRESH_SECONDS = int(os.getenv('ANSWER_INDEX_REFRESH_SECONDS', '60'))
+ANSWER_INDEX_CHUNK_SIZE = int(os.getenv('ANSWER_INDEX_CHUNK_SIZE', '200'))
+
+# Sessioni in memoria: dopo SESSION_IDLE_TTL secondi di inattività vengono rilette dal database
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', '1800'))
+SESSION_SWEEP_SECONDS = int(os.getenv('SESSION_SWEEP_SECONDS', '60'))
+
+# Watchdog del ritardo dell'event loop: oltre LOOP_LAG_THRESHOLD secondi logga lo stack bloccante; 0 = disattivato
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.1'))
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.25'))
+# Istogramma del ritardo nei log ogni LOOP_LAG_METRICS_INTERVAL secondi; 0 = mai
+LOOP_LAG_METRICS_INTERVAL = int(os.getenv('LOOP_LAG_METRICS_INTERVAL', '300'))
+
+# Modello e budget di token per le risposte (vedi ResponseBudgetController)
+RESPONSE_POLICY = os.getenv('RESPONSE_POLICY', 'fixed')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+OPENAI_PREMIUM_MODEL = os.getenv('OPENAI_PREMIUM_MODEL', OPENAI_MODEL)
+OPENAI_FAST_MODEL = os.getenv('OPENAI_FAST_MODEL', OPENAI_MODEL)
+OPENAI_MAX_TOKENS = int(os.getenv('OPENAI_MAX_TOKENS', '50'))
+OPENAI_PREMIUM_MAX_TOKENS = int(os.getenv('OPENAI_PREMIUM_MAX_TOKENS', '90'))
+OPENAI_LATENCY_TARGET = float(os.getenv('OPENAI_LATENCY_TARGET', '4'))
 
 SUBSCRIPTIONS = {
-    'free': {'name': 'Free', 'questions': 50, 'cooldown': 15, 'price': 0},
-    'premium_6m': {'name': '6 Months Premium', 'questions': -1, 'cooldown': 10, 'price': 299},
-    'premium_12m': {'name': '12 Months Premium', 'questions': -1, 'cooldown': 5, 'price': 499}
+    'free': {'name': 'Free', 'questions': 50, 'cooldown': 15, 'price': 0, 'model': OPENAI_MODEL, 'max_tokens': OPENAI_MAX_TOKENS},
+    'premium_6m': {'name': '6 Months Premium', 'questions': -1, 'cooldown': 10, 'price': 299, 'model': OPENAI_PREMIUM_MODEL, 'max_tokens': OPENAI_PREMIUM_MAX_TOKENS},
+    'premium_12m': {'name': '12 Months Premium', 'questions': -1, 'cooldown': 5, 'price': 499, 'model': OPENAI_PREMIUM_MODEL, 'max_tokens': OPENAI_PREMIUM_MAX_TOKENS}
 }
 
 # Immagini intro per presentazione angeli
@@ -159,7 +246,7 @@ class SafetyFilters:
             r'\b(never|always|impossible|definitely not)\b'
         ]
     
-    def validate_response(self, response: str) -> dict:
+    def validate_response(self, response: str, max_length: int = 200) -> dict:
         # Check forbidden content
         for pattern in self.forbidden_patterns:
             if re.search(pattern, response.lower()):
@@ -169,7 +256,7 @@ class SafetyFilters:
                 }
         
         # Check length
-        if len(response) > 200:
+        if len(response) > max_length:
             return {
                 'is_safe': False,
                 'reason': 'Response too long'
@@ -190,11 +277,394 @@ class SafetyFilters:
             'content': response
         }
 
+ResponsePlan = namedtuple('ResponsePlan', ['policy', 'model', 'max_tokens', 'temperature'])
+
+class ResponseBudgetController:
+    """Sceglie modello e max_tokens per ogni richiesta a OpenAI.
+
+    Politiche:
+    - fixed: OPENAI_MODEL e OPENAI_MAX_TOKENS per tutti, come sempre
+    - tiered: modello e token del piano dell'utente (SUBSCRIPTIONS, OPENAI_PREMIUM_MAX_TOKENS per i premium)
+    - adaptive: come tiered, ma passa a OPENAI_FAST_MODEL con meno token
+      quando la latenza media supera `latency_target`, accorcia le risposte
+      se SafetyFilters le scarta spesso come troppo lunghe e abbassa la
+      temperatura se troppe contengono frasi vietate
+    """
+    POLICIES = ('fixed', 'tiered', 'adaptive')
+    MIN_TOKENS = 25
+
+    def __init__(self, policy: str, fast_model: str, latency_target: float, window: int = 50, rejection_threshold: float = 0.2):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown response policy '{policy}', expected one of {self.POLICIES}")
+        self.policy = policy
+        self.fast_model = fast_model
+        self.latency_target = latency_target
+        self.rejection_threshold = rejection_threshold
+        self.latency_ewma = None
+        self._rejections = deque(maxlen=window)
+        self.stats = {'served': {}}
+
+    def plan(self, tier: str) -> ResponsePlan:
+        if self.policy == 'fixed':
+            return ResponsePlan('fixed', OPENAI_MODEL, OPENAI_MAX_TOKENS, 0.8)
+
+        sub_info = SUBSCRIPTIONS.get(tier, SUBSCRIPTIONS['free'])
+        model, max_tokens, temperature = sub_info['model'], sub_info['max_tokens'], 0.8
+        if self.policy == 'tiered':
+            return ResponsePlan('tiered', model, max_tokens, temperature)
+
+        if self.latency_ewma is not None and self.latency_ewma > self.latency_target:
+            model = self.fast_model
+            max_tokens = int(max_tokens * 0.8)
+
+        too_long = self._rejection_rate('Response too long')
+        if too_long > self.rejection_threshold:
+            max_tokens = int(max_tokens * (1 - too_long))
+
+        if self._rejection_rate('Contains forbidden pattern') > self.rejection_threshold:
+            temperature = 0.6
+
+        return ResponsePlan('adaptive', model, max(self.MIN_TOKENS, max_tokens), temperature)
+
+    def record_latency(self, seconds: float):
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * seconds
+
+    def record_validation(self, plan: ResponsePlan, filtered_response: dict):
+        self._rejections.append(None if filtered_response['is_safe'] else filtered_response['reason'])
+        label = describe_plan(plan)
+        self.stats['served'][label] = self.stats['served'].get(label, 0) + 1
+
+    def _rejection_rate(self, reason_prefix: str) -> float:
+        # Con pochi campioni il tasso non è affidabile
+        if len(self._rejections) < 10:
+            return 0.0
+        rejected = sum(1 for reason in self._rejections if reason and reason.startswith(reason_prefix))
+        return rejected / len(self._rejections)
+
+    def metrics(self) -> dict:
+        return {
+            'policy': self.policy,
+            'latency_ewma': round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+            'too_long_rate': round(self._rejection_rate('Response too long'), 2),
+            'served': dict(self.stats['served'])
+        }
+
+def describe_plan(plan: ResponsePlan) -> str:
+    return f"{plan.policy}:{plan.model}/{plan.max_tokens}"
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Stati closed / open / half_open attorno alle chiamate verso OpenAI.
+
+    Scatta dopo `failure_threshold` errori consecutivi o quando gli errori
+    superano `error_rate` sulle ultime `window` chiamate. Dopo `open_seconds`
+    lascia passare al massimo `half_open_probes` richieste di prova: se
+    vanno tutte bene si richiude, al primo errore si riapre.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, error_rate, window, open_seconds, half_open_probes):
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.stats = {'rejected': 0, 'transitions': {}}
+
+    def rejects_requests(self) -> bool:
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at < self.open_seconds
+        if self.state == self.HALF_OPEN:
+            return self._probes_in_flight >= self.half_open_probes
+        return False
+
+    def reject(self) -> bool:
+        """Come rejects_requests, ma conta il rifiuto: per chi rinuncia alla chiamata senza acquire()"""
+        if not self.rejects_requests():
+            return False
+        self.stats['rejected'] += 1
+        return True
+
+    def acquire(self) -> bool:
+        """Prenota una chiamata; restituisce True se è una richiesta di prova"""
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(self.HALF_OPEN)
+
+        if self.rejects_requests():
+            self.stats['rejected'] += 1
+            raise CircuitOpenError(f"circuit {self.state}")
+
+        if self.state == self.HALF_OPEN:
+            self._probes_in_flight += 1
+            return True
+        return False
+
+    def release(self, probe: bool):
+        """Chiamata annullata prima di un esito: non conta né come successo né come errore"""
+        if probe:
+            self._probes_in_flight -= 1
+
+    def record_success(self, probe: bool):
+        self._consecutive_failures = 0
+        if probe:
+            self._probes_in_flight -= 1
+            self._probe_successes += 1
+            if self.state == self.HALF_OPEN and self._probe_successes >= self.half_open_probes:
+                self._transition(self.CLOSED)
+            return
+        self._outcomes.append(True)
+
+    def record_failure(self, probe: bool):
+        if probe:
+            self._probes_in_flight -= 1
+            if self.state == self.HALF_OPEN:
+                self._transition(self.OPEN)
+            return
+
+        self._consecutive_failures += 1
+        self._outcomes.append(False)
+        if self.state != self.CLOSED:
+            return
+
+        failures = self._outcomes.count(False)
+        window_full = len(self._outcomes) == self._outcomes.maxlen
+        if self._consecutive_failures >= self.failure_threshold or (window_full and failures / len(self._outcomes) >= self.error_rate):
+            self._transition(self.OPEN)
+
+    def _transition(self, state):
+        key = f"{self.state}->{state}"
+        self.stats['transitions'][key] = self.stats['transitions'].get(key, 0) + 1
+        logger.warning(f"OpenAI circuit breaker: {key}")
+
+        self.state = state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        elif state == self.HALF_OPEN:
+            self._probe_successes = 0
+        else:
+            self._outcomes.clear()
+            self._consecutive_failures = 0
+
+    def metrics(self) -> dict:
+        failures = self._outcomes.count(False)
+        return {
+            'state': self.state,
+            'consecutive_failures': self._consecutive_failures,
+            'error_rate': round(failures / len(self._outcomes), 2) if self._outcomes else 0.0,
+            'rejected': self.stats['rejected'],
+            'transitions': dict(self.stats['transitions'])
+        }
+
+class _AngelPostings:
+    __slots__ = ('term_ids', 'terms', 'postings', 'answers', 'doc_terms')
+
+    def __init__(self):
+        self.term_ids = {}
+        self.terms = []
+        self.postings = []
+        self.answers = []
+        self.doc_terms = []
+
+class AnswerIndex:
+    """Indice invertito in memoria delle risposte AI passate, separato per angelo.
+
+    Le parole delle domande diventano id interi e ogni posting list è un
+    array('I') di documenti. Per angelo si tengono al massimo `max_docs`
+    risposte: quando il limite è raggiunto la metà più vecchia viene scartata
+    e l'indice ricostruito.
+    """
+    _TOKEN_PATTERN = re.compile(r"[a-z][a-z']{2,}")
+    _STOPWORDS = frozenset({
+        'the', 'and', 'for', 'are', 'but', 'not', 'you', 'your', 'with', 'this', 'that', 'have',
+        'has', 'was', 'were', 'what', 'when', 'where', 'who', 'why', 'how', 'will', 'would',
+        'should', 'could', 'can', 'does', 'did', 'about', 'from', 'into', 'there', 'their',
+        'them', 'they', 'then', 'than', 'its', "it's", "i'm", 'any', 'all', 'get', 'our'
+    })
+
+    def __init__(self, max_docs: int):
+        self.max_docs = max_docs
+        self.last_log_id = 0
+        self._angels = {}
+
+    def _tokens(self, text: str) -> set:
+        return {token for token in self._TOKEN_PATTERN.findall(text.lower()) if token not in self._STOPWORDS}
+
+    def add(self, angel_type: str, question: str, answer: str):
+        postings = self._angels.get(angel_type)
+        if postings is None:
+            postings = self._angels[angel_type] = _AngelPostings()
+        elif len(postings.answers) >= self.max_docs:
+            postings = self._angels[angel_type] = self._compact(postings)
+
+        self._add_document(postings, self._tokens(question), answer)
+
+    def _add_document(self, postings, tokens, answer):
+        doc_id = len(postings.answers)
+        term_ids = array('I')
+        for token in tokens:
+            term_id = postings.term_ids.get(token)
+            if term_id is None:
+                term_id = postings.term_ids[token] = len(postings.terms)
+                postings.terms.append(token)
+                postings.postings.append(array('I'))
+            postings.postings[term_id].append(doc_id)
+            term_ids.append(term_id)
+
+        postings.answers.append(answer)
+        postings.doc_terms.append(term_ids)
+
+    def _compact(self, old):
+        keep = max(1, self.max_docs // 2)
+        compacted = _AngelPostings()
+        for term_ids, answer in zip(old.doc_terms[-keep:], old.answers[-keep:]):
+            self._add_document(compacted, {old.terms[term_id] for term_id in term_ids}, answer)
+        return compacted
+
+    def lookup(self, angel_type: str, question: str):
+        """Risposta passata più affine per parole chiave (pesate per rarità), o None"""
+        postings = self._angels.get(angel_type)
+        if not postings or not postings.answers:
+            return None
+
+        doc_count = len(postings.answers)
+        scores = {}
+        for token in self._tokens(question):
+            term_id = postings.term_ids.get(token)
+            if term_id is None:
+                continue
+            docs = postings.postings[term_id]
+            weight = math.log(1 + doc_count / len(docs))
+            for doc_id in docs:
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight
+
+        if not scores:
+            return None
+
+        # A parità di punteggio vince la risposta più recente
+        best = max(scores, key=lambda doc_id: (scores[doc_id], doc_id))
+        return postings.answers[best]
+
+    def metrics(self) -> dict:
+        return {
+            angel_type: {
+                'answers': len(postings.answers),
+                'terms': len(postings.terms),
+                'postings': sum(len(docs) for docs in postings.postings)
+            }
+            for angel_type, postings in self._angels.items()
+        }
+
+class QuestionBatcher:
+    """Raccoglie le domande con la stessa chiave per `window` secondi e le invia in una sola richiesta.
+
+    `batch_call(key, items)` restituisce una risposta per domanda o solleva
+    ValueError se la risposta non si lascia dividere; in quel caso ogni
+    domanda passa da `single_call(key, item)`.
+    """
+    def __init__(self, batch_call, single_call, window: float, max_size: int):
+        self.batch_call = batch_call
+        self.single_call = single_call
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+        self.stats = {'batches': 0, 'batched_questions': 0, 'single_calls': 0, 'parse_failures': 0}
+
+    def metrics(self) -> dict:
+        return {**self.stats, 'waiting': sum(len(items) for items in self._pending.values())}
+
+    async def submit(self, key, item: tuple) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((item, future))
+
+        if len(pending) >= self.max_size:
+            self._start_flush(key)
+        elif len(pending) == 1:
+            self._timers[key] = loop.call_later(self.window, self._start_flush, key)
+
+        return await future
+
+    def _start_flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+
+        batch = self._pending.pop(key, None)
+        if batch:
+            task = asyncio.create_task(self._flush(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, key, batch):
+        if len(batch) == 1:
+            await self._answer_individually(key, batch)
+            return
+
+        try:
+            answers = await self.batch_call(key, [item for item, _ in batch])
+        except ValueError as e:
+            self.stats['parse_failures'] += 1
+            logger.warning(f"Batched answer could not be split ({e}), asking individually")
+            await self._answer_individually(key, batch)
+            return
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.stats['batches'] += 1
+        self.stats['batched_questions'] += len(batch)
+        for (_, future), answer in zip(batch, answers):
+            if not future.done():
+                future.set_result(answer)
+
+    async def _answer_individually(self, key, batch):
+        self.stats['single_calls'] += len(batch)
+        results = await asyncio.gather(
+            *(self.single_call(key, item) for item, _ in batch),
+            return_exceptions=True
+        )
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
 class AngelAISystem:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, batch_window_ms: int = 0, batch_max_size: int = 8, circuit_breaker=None, answer_index=None, budget=None):
         self.api_key = api_key
+        self.answer_index = answer_index
+        self.budget = budget or ResponseBudgetController('fixed', OPENAI_MODEL, OPENAI_LATENCY_TARGET)
         self.safety_filters = SafetyFilters()
         self.fallback_responses = self._load_fallback_responses()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(
+            CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_ERROR_RATE, CIRCUIT_WINDOW,
+            CIRCUIT_OPEN_SECONDS, CIRCUIT_HALF_OPEN_PROBES
+        )
+        self.batcher = None
+        if batch_window_ms > 0 and batch_max_size > 1:
+            self.batcher = QuestionBatcher(
+                self._call_openai_batch, self._call_openai_single,
+                batch_window_ms / 1000, batch_max_size
+            )
         
     def _load_fallback_responses(self):
         return {
@@ -214,34 +684,112 @@ class AngelAISystem:
             ]
         }
     
-    async def generate_response(self, angel_type: str, user_question: str, user_name: str, birth_date: str) -> dict:
+    async def generate_response(self, angel_type: str, user_question: str, user_name: str, birth_date: str, tier: str = 'free') -> dict:
+        if not self.api_key:
+            return self._get_fallback_response(angel_type, user_question)
+
+        # OpenAI non risponde: niente attesa per una richiesta destinata a fallire
+        if self.circuit_breaker.reject():
+            return self._get_fallback_response(angel_type, user_question)
+
+        plan = self.budget.plan(tier)
+
+        if self.batcher:
+            # Solo domande con lo stesso angelo e lo stesso piano finiscono nella stessa richiesta
+            ai_call = self.batcher.submit((angel_type, plan), (user_question, user_name, birth_date))
+            return await self._validated_response(angel_type, ai_call, plan, user_question)
+
+        prompt = self._create_prompt(angel_type, user_question, user_name, birth_date, plan)
+        return await self._generate_from_prompt(angel_type, prompt, plan, user_question)
+
+    async def generate_daily_message(self, angel_type: str) -> dict:
+        """Messaggio del giorno, uguale per tutti gli iscritti allo stesso angelo"""
         if not self.api_key:
             return self._get_fallback_response(angel_type)
-        
+
+        plan = self.budget.plan('free')
+        return await self._generate_from_prompt(angel_type, self._create_daily_prompt(angel_type, plan), plan)
+
+    async def _generate_from_prompt(self, angel_type: str, prompt: str, plan: ResponsePlan, question: str = None) -> dict:
+        return await self._validated_response(angel_type, self._call_openai(prompt, plan), plan, question)
+
+    async def _validated_response(self, angel_type: str, ai_call, plan: ResponsePlan, question: str = None) -> dict:
         try:
-            prompt = self._create_prompt(angel_type, user_question, user_name, birth_date)
-            ai_response = await self._call_openai(prompt)
+            ai_response = await ai_call
             
-            # Validate response
-            filtered_response = self.safety_filters.validate_response(ai_response)
+            # Validate response: i piani con più token possono rispondere più a lungo (~4 caratteri per token)
+            filtered_response = self.safety_filters.validate_response(ai_response, max(200, plan.max_tokens * 4))
+            self.budget.record_validation(plan, filtered_response)
             
             if not filtered_response['is_safe']:
                 logger.warning(f"AI response filtered: {filtered_response['reason']}")
-                return self._get_fallback_response(angel_type)
+                return self._get_fallback_response(angel_type, question)
             
             return {
                 'success': True,
                 'response': filtered_response['content'],
                 'method': 'ai',
                 'has_image': random.random() < 0.33,  # 1/3 chance for image
-                'angel_type': angel_type
+                'angel_type': angel_type,
+                'policy': describe_plan(plan)
             }
-            
+
+        except CircuitOpenError:
+            return self._get_fallback_response(angel_type, question)
         except Exception as e:
             logger.warning(f"AI system failed: {e}")
-            return self._get_fallback_response(angel_type)
+            return self._get_fallback_response(angel_type, question)
     
-    def _create_prompt(self, angel_type: str, question: str, name: str, birth_date: str) -> str:
+    def _create_prompt(self, angel_type: str, question: str, name: str, birth_date: str, plan: ResponsePlan) -> str:
+        config = self._angel_config(angel_type)
+
+        return f"""{self._prompt_header(angel_type, plan)}
+
+User: {name} (born {birth_date})
+Question: "{question}"
+
+Provide a brief mystical response as {config['name']} that offers spiritual guidance while staying true to your {angel_type} nature."""
+
+    def _create_batch_prompt(self, angel_type: str, items: list, plan: ResponsePlan) -> str:
+        config = self._angel_config(angel_type)
+        seekers = '\n'.join(
+            f'{i}. User: {name} (born {birth_date}) - Question: "{question}"'
+            for i, (question, name, birth_date) in enumerate(items, 1)
+        )
+
+        return f"""{self._prompt_header(angel_type, plan)}
+
+Answer each of these {len(items)} seekers separately:
+{seekers}
+
+Reply ONLY with a JSON array of exactly {len(items)} strings, in the same order, each a brief mystical response as {config['name']} that offers spiritual guidance while staying true to your {angel_type} nature."""
+
+    def _create_daily_prompt(self, angel_type: str, plan: ResponsePlan) -> str:
+        config = self._angel_config(angel_type)
+
+        return f"""{self._prompt_header(angel_type, plan)}
+
+Today is {datetime.now().strftime('%A, %d %B %Y')}.
+
+Provide a brief mystical message for the day as {config['name']}, addressed to every seeker who follows you, staying true to your {angel_type} nature."""
+
+    def _prompt_header(self, angel_type: str, plan: ResponsePlan) -> str:
+        config = self._angel_config(angel_type)
+        # ~0.7 parole per token: 50 token -> 35 parole
+        word_limit = round(plan.max_tokens * 0.7)
+
+        return f"""You are {config['name']}, the Angel of {'Light' if angel_type == 'light' else 'Darkness'}.
+
+STRICT GUIDELINES:
+- Provide mystical guidance in {config['tone']} tone
+- Keep response under {word_limit} words
+- Use elements: {config['elements']}
+- NO specific future predictions
+- NO medical, financial, or legal advice
+- Keep language poetic and spiritually ambiguous
+- Focus on inner wisdom and personal growth"""
+
+    def _angel_config(self, angel_type: str) -> dict:
         angel_config = {
             'light': {
                 'name': 'Seraphiel',
@@ -256,26 +804,36 @@ class AngelAISystem:
                 'tone': 'profound and mystical'
             }
         }
-        
-        config = angel_config[angel_type]
-        
-        return f"""You are {config['name']}, the Angel of {'Light' if angel_type == 'light' else 'Darkness'}.
 
-STRICT GUIDELINES:
-- Provide mystical guidance in {config['tone']} tone
-- Keep response under 35 words
-- Use elements: {config['elements']}
-- NO specific future predictions
-- NO medical, financial, or legal advice  
-- Keep language poetic and spiritually ambiguous
-- Focus on inner wisdom and personal growth
+        return angel_config[angel_type]
 
-User: {name} (born {birth_date})
-Question: "{question}"
+    async def _call_openai_single(self, key: tuple, item: tuple) -> str:
+        angel_type, plan = key
+        return await self._call_openai(self._create_prompt(angel_type, *item, plan), plan)
 
-Provide a brief mystical response as {config['name']} that offers spiritual guidance while staying true to your {angel_type} nature."""
+    async def _call_openai_batch(self, key: tuple, items: list) -> list:
+        angel_type, plan = key
+        # Stesso budget per risposta della chiamata singola, più un margine per il JSON
+        raw = await self._call_openai(self._create_batch_prompt(angel_type, items, plan), plan, max_tokens=(plan.max_tokens + 10) * len(items))
+        return self._split_batch_answers(raw, len(items))
+
+    def _split_batch_answers(self, raw: str, expected: int) -> list:
+        text = raw.strip()
+        if text.startswith('```'):
+            text = text.strip('`')
+            if text.startswith('json'):
+                text = text[len('json'):]
+
+        answers = json.loads(text)
+        if not isinstance(answers, list) or len(answers) != expected:
+            raise ValueError(f"expected a list of {expected} answers")
+        if not all(isinstance(answer, str) for answer in answers):
+            raise ValueError("answers must be strings")
+
+        return [answer.strip() for answer in answers]
 
-    async def _call_openai(self, prompt: str) -> str:
+    async def _call_openai(self, prompt: str, plan: ResponsePlan, max_tokens: int = None) -> str:
+        requested_tokens = max_tokens or plan.max_tokens
         url = "https://api.openai.com/v1/chat/completions"
         headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -283,18 +841,36 @@ Provide a brief mystical response as {config['name']} that offers spiritual guid
         }
         
         data = {
-            "model": "gpt-3.5-turbo",
+            "model": plan.model,
             "messages": [
                 {"role": "system", "content": "You are a mystical oracle providing brief spiritual guidance for entertainment purposes only."},
                 {"role": "user", "content": prompt}
             ],
-            "max_tokens": 50,
-            "temperature": 0.8,
+            "max_tokens": requested_tokens,
+            "temperature": plan.temperature,
             "presence_penalty": 0.3,
             "frequency_penalty": 0.3
         }
         
-        async with aiohttp.ClientSession() as session:
+        probe = self.circuit_breaker.acquire()
+        started = time.monotonic()
+        try:
+            content = await self._post_openai(url, headers, data)
+        except asyncio.CancelledError:
+            self.circuit_breaker.release(probe)
+            raise
+        except Exception:
+            self.circuit_breaker.record_failure(probe)
+            raise
+
+        self.circuit_breaker.record_success(probe)
+        # Anche per un batch conta l'attesa vista dagli utenti: è nei picchi che serve il modello veloce
+        self.budget.record_latency(time.monotonic() - started)
+        return content
+
+    async def _post_openai(self, url: str, headers: dict, data: dict) -> str:
+        timeout = aiohttp.ClientTimeout(total=OPENAI_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
             async with session.post(url, headers=headers, json=data) as response:
                 if response.status == 200:
                     result = await response.json()
@@ -302,24 +878,490 @@ Provide a brief mystical response as {config['name']} that offers spiritual guid
                 else:
                     raise Exception(f"OpenAI API error: {response.status}")
     
-    def _get_fallback_response(self, angel_type: str) -> dict:
-        response_text = random.choice(self.fallback_responses[angel_type])
+    def _get_fallback_response(self, angel_type: str, question: str = None) -> dict:
+        # Prima una risposta AI passata a una domanda simile, poi le frasi fisse
+        response_text = None
+        if self.answer_index and question:
+            response_text = self.answer_index.lookup(angel_type, question)
+
+        method = 'history'
+        if response_text is None:
+            response_text = random.choice(self.fallback_responses[angel_type])
+            method = 'fallback'
+
         return {
             'success': True,
             'response': response_text,
-            'method': 'fallback',
+            'method': method,
             'has_image': random.random() < 0.33,
             'angel_type': angel_type
         }
 
+class AsyncRateLimiter:
+    """Distribuisce le acquisizioni a intervalli regolari (max `rate` al secondo)"""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            wait = self._next_slot - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                now = self._next_slot
+            self._next_slot = now + self.interval
+
+class _OutboundJob:
+    __slots__ = ('args', 'kwargs', 'future')
+
+    def __init__(self, args, kwargs, future):
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+
+class _ChatSendState:
+    __slots__ = ('lock', 'tokens', 'updated', 'waiters')
+
+    def __init__(self, burst, now):
+        self.lock = asyncio.Lock()
+        self.tokens = burst
+        self.updated = now
+        self.waiters = 0
+
+class OutboundDispatcher(BaseRateLimiter):
+    """Coda centrale per tutte le chiamate Bot API in uscita.
+
+    Ogni richiesta con un chat_id passa da un limite per chat (token bucket,
+    ordine FIFO) e da un limite globale. I RetryAfter (429) mettono in pausa
+    tutti gli invii e la richiesta viene ritentata invece di fallire; le
+    modifiche ravvicinate dello stesso messaggio vengono fuse in una sola.
+    """
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries, metrics_interval=0):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.metrics_interval = metrics_interval
+        self._global_limiter = AsyncRateLimiter(global_rate)
+        self._paused_until = 0.0
+        self._chats = {}
+        self._pending_edits = {}
+        self._metrics_task = None
+        self.stats = {'queued': 0, 'in_flight': 0, 'sent': 0, 'retried': 0, 'coalesced': 0, 'failed': 0}
+
+    async def initialize(self):
+        if self.metrics_interval > 0:
+            self._metrics_task = asyncio.create_task(self._log_metrics())
+
+    async def shutdown(self):
+        if self._metrics_task:
+            self._metrics_task.cancel()
+            try:
+                await self._metrics_task
+            except asyncio.CancelledError:
+                pass
+            self._metrics_task = None
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            'chats_waiting': len(self._chats),
+            'pending_edits': len(self._pending_edits),
+            'paused_for': max(0.0, round(self._paused_until - asyncio.get_running_loop().time(), 1))
+        }
+
+    async def _log_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            logger.info(f"Outbound queue: {self.metrics()}")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery, ... non sono messaggi in una chat
+            return await callback(*args, **kwargs)
+
+        edit_key = None
+        if endpoint == 'editMessageText' and data.get('message_id') is not None:
+            edit_key = (chat_id, data['message_id'])
+            pending = self._pending_edits.get(edit_key)
+            if pending is not None:
+                # Vince l'ultima modifica; tutti i chiamanti ricevono lo stesso risultato
+                pending.args, pending.kwargs = args, kwargs
+                self.stats['coalesced'] += 1
+                try:
+                    return await asyncio.shield(pending.future)
+                except asyncio.CancelledError:
+                    if not pending.future.cancelled():
+                        raise
+                    # È stato annullato chi doveva inviare, non questo chiamante: l'ultima modifica riparte da qui
+                    return await self.process_request(callback, pending.args, pending.kwargs, endpoint, data, rate_limit_args)
+
+        job = _OutboundJob(args, kwargs, asyncio.get_running_loop().create_future())
+        if edit_key is not None:
+            self._pending_edits[edit_key] = job
+
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatSendState(self.chat_burst, asyncio.get_running_loop().time())
+        state.waiters += 1
+        self.stats['queued'] += 1
+        queued = True
+
+        try:
+            async with state.lock:
+                self.stats['queued'] -= 1
+                queued = False
+                await self._wait_chat_slot(state)
+                result = await self._send(callback, job, edit_key)
+            job.future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.future.set_exception(e)
+            job.future.exception()
+            raise
+        finally:
+            if queued:
+                self.stats['queued'] -= 1
+            state.waiters -= 1
+            if not state.waiters:
+                del self._chats[chat_id]
+            if edit_key is not None and self._pending_edits.get(edit_key) is job:
+                del self._pending_edits[edit_key]
+            if not job.future.done():
+                job.future.cancel()
+
+    async def _wait_chat_slot(self, state):
+        now = asyncio.get_running_loop().time()
+        state.tokens = min(self.chat_burst, state.tokens + (now - state.updated) * self.chat_rate)
+        state.updated = now
+        if state.tokens < 1:
+            await asyncio.sleep((1 - state.tokens) / self.chat_rate)
+            state.tokens = 1
+            state.updated = asyncio.get_running_loop().time()
+        state.tokens -= 1
+
+    async def _wait_global_slot(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = self._paused_until - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._global_limiter.acquire()
+            # Una pausa decisa mentre si aspettava il turno vale anche per chi era già in fila
+            if self._paused_until <= loop.time():
+                return
+
+    async def _send(self, callback, job, edit_key):
+        attempt = 0
+        while True:
+            await self._wait_global_slot()
+            if edit_key is not None and self._pending_edits.get(edit_key) is job:
+                del self._pending_edits[edit_key]
+
+            self.stats['in_flight'] += 1
+            try:
+                result = await callback(*job.args, **job.kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    self.stats['failed'] += 1
+                    raise
+                attempt += 1
+                self.stats['retried'] += 1
+                self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + e.retry_after)
+                logger.warning(f"Flood control: pausing outbound messages for {e.retry_after}s (attempt {attempt}/{self.max_retries})")
+                if edit_key is not None:
+                    self._pending_edits.setdefault(edit_key, job)
+                continue
+            except Exception:
+                self.stats['failed'] += 1
+                raise
+            finally:
+                self.stats['in_flight'] -= 1
+
+            self.stats['sent'] += 1
+            return result
+
+class _UserUpdateState:
+    __slots__ = ('lock', 'waiters', 'questions')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+        self.questions = set()
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Aggiornamenti di utenti diversi in parallelo, quelli dello stesso utente in ordine.
+
+    Il lock per utente è FIFO e viene preso prima del semaforo globale, così
+    un utente con molti aggiornamenti in coda non occupa posti che servono
+    agli altri. Una domanda identica a una ancora in corso viene scartata.
+    """
+    def __init__(self, max_concurrent_updates, max_pending_updates, watchdog=None):
+        super().__init__(max_pending_updates)
+        self._active = asyncio.Semaphore(max_concurrent_updates)
+        self._users = {}
+        self.watchdog = watchdog
+        self.stats = {'processed': 0, 'deduplicated': 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def metrics(self) -> dict:
+        return {**self.stats, 'users_waiting': len(self._users)}
+
+    async def do_process_update(self, update, coroutine):
+        user_key = self._user_key(update)
+        if user_key is None:
+            async with self._active:
+                await self._run(update, coroutine)
+            self.stats['processed'] += 1
+            return
+
+        state = self._users.get(user_key)
+        if state is None:
+            state = self._users[user_key] = _UserUpdateState()
+
+        question = self._question_key(update)
+        if question is not None:
+            if question in state.questions:
+                coroutine.close()
+                self.stats['deduplicated'] += 1
+                logger.info(f"Dropped duplicate question from user {user_key}")
+                if not state.waiters:
+                    del self._users[user_key]
+                return
+            state.questions.add(question)
+
+        state.waiters += 1
+        try:
+            async with state.lock:
+                async with self._active:
+                    await self._run(update, coroutine)
+            self.stats['processed'] += 1
+        finally:
+            state.waiters -= 1
+            state.questions.discard(question)
+            if not state.waiters:
+                del self._users[user_key]
+
+    async def _run(self, update, coroutine):
+        if not self.watchdog:
+            await coroutine
+            return
+        with self.watchdog.tracking(update):
+            await coroutine
+
+    def _user_key(self, update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    def _question_key(self, update):
+        message = update.message
+        if not message or not message.text or message.text.startswith('/'):
+            return None
+        return ' '.join(message.text.lower().split())
+
+def describe_update(update) -> str:
+    """Riassunto di un aggiornamento per i log, senza il testo dei messaggi"""
+    if not isinstance(update, Update):
+        return repr(update)[:80]
+    user_id = update.effective_user.id if update.effective_user else None
+    if update.callback_query:
+        what = f"callback {update.callback_query.data}"
+    elif update.message and update.message.text:
+        text = update.message.text
+        what = f"command {text.split()[0]}" if text.startswith('/') else f"text ({len(text)} chars)"
+    elif update.message and update.message.successful_payment:
+        what = "payment"
+    elif update.pre_checkout_query:
+        what = "pre_checkout"
+    else:
+        what = "other"
+    return f"update {update.update_id} from user {user_id}: {what}"
+
+class LoopLagWatchdog:
+    """Misura il ritardo dell'event loop e trova chi lo blocca.
+
+    Un task si risveglia ogni `interval` secondi e registra quanto tardi è
+    arrivato in un istogramma. Un thread separato controlla il battito: se il
+    loop non si fa vivo da più di `threshold` secondi, legge lo stack del
+    thread del loop con sys._current_frames() e lo logga insieme
+    all'aggiornamento che il task corrente sta gestendo. Uno stack per blocco.
+    """
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self, interval: float, threshold: float, metrics_interval: int):
+        self.interval = interval
+        self.threshold = threshold
+        self.metrics_interval = metrics_interval
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+        self.stats = {'samples': 0, 'max_lag_ms': 0, 'stalls': 0}
+        self._updates = {}
+        self._loop = None
+        self._loop_thread_id = None
+        self._last_beat = time.monotonic()
+        self._reported_beat = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def tracking(self, update):
+        return _TrackedUpdate(self._updates, update)
+
+    def start(self) -> asyncio.Task:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True)
+        self._thread.start()
+        return asyncio.create_task(self._beat())
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval * 2)
+            self._thread = None
+
+    def record(self, lag: float):
+        lag_ms = lag * 1000
+        bucket = 0
+        while bucket < len(self.BUCKETS_MS) and lag_ms > self.BUCKETS_MS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        self.stats['samples'] += 1
+        self.stats['max_lag_ms'] = max(self.stats['max_lag_ms'], round(lag_ms))
+
+    def metrics(self) -> dict:
+        labels = [f"<={limit}ms" for limit in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        return {
+            **self.stats,
+            'histogram': {label: count for label, count in zip(labels, self.histogram) if count}
+        }
+
+    async def _beat(self):
+        last_metrics = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._last_beat = now = time.monotonic()
+            self.record(max(0.0, now - expected))
+
+            if self.metrics_interval > 0 and now - last_metrics >= self.metrics_interval:
+                last_metrics = now
+                logger.info(f"Event loop lag: {self.metrics()}")
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            stalled_for = time.monotonic() - beat
+            if stalled_for < self.threshold or beat == self._reported_beat:
+                continue
+
+            self._reported_beat = beat
+            self.stats['stalls'] += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else '<no frame>\n'
+
+            task = asyncio.current_task(self._loop)
+            update = self._updates.get(task)
+            if update is not None:
+                current = describe_update(update)
+            else:
+                current = f"task {task.get_name()}" if task else "no task"
+
+            logger.warning(
+                f"Event loop blocked for over {stalled_for:.2f}s while handling {current}\n"
+                f"Loop thread stack (most recent call last):\n{stack}"
+            )
+
+class _TrackedUpdate:
+    __slots__ = ('updates', 'update', 'task')
+
+    def __init__(self, updates, update):
+        self.updates = updates
+        self.update = update
+        self.task = None
+
+    def __enter__(self):
+        self.task = asyncio.current_task()
+        self.updates[self.task] = self.update
+
+    def __exit__(self, *exc_info):
+        self.updates.pop(self.task, None)
+
 class DatabaseManager:
-    def __init__(self, db_path):
+    def __init__(self, db_path, read_pool_size=4):
         self.db_path = db_path
+        # Il replay accelerato riduce i cooldown nella stessa proporzione del tempo
+        self.cooldown_scale = 1.0
         self.init_database()
+        self._read_pool = queue.LifoQueue(maxsize=read_pool_size)
+        for _ in range(read_pool_size):
+            self._read_pool.put_nowait(self._connect_reader())
+    
+    def close(self):
+        while True:
+            try:
+                self._read_pool.get_nowait().close()
+            except queue.Empty:
+                return
     
+    def _connect(self):
+        # Con più processi sullo stesso file si aspetta il lock invece di fallire subito
+        return sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT)
+
+    def _connect_reader(self):
+        # Solo lettura e persistente: la cache degli statement resta valida tra una query e l'altra
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        return sqlite3.connect(uri, uri=True, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False, cached_statements=64)
+
+    def _read(self, sql, params, fetch):
+        try:
+            conn = self._read_pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect_reader()
+
+        try:
+            cursor = conn.execute(sql, params)
+            # Il cursore va chiuso subito: uno statement aperto tiene fermo lo snapshot WAL
+            try:
+                return fetch(cursor)
+            finally:
+                cursor.close()
+        finally:
+            try:
+                self._read_pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def _fetchone(self, sql, params=()):
+        return self._read(sql, params, lambda cursor: cursor.fetchone())
+
+    def _fetchall(self, sql, params=()):
+        return self._read(sql, params, lambda cursor: cursor.fetchall())
+
     def init_database(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
+
+        # WAL: le letture non bloccano l'unico scrittore (anche tra processi)
+        cursor.execute("PRAGMA journal_mode=WAL")
         
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -348,31 +1390,67 @@ class DatabaseManager:
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_messages (
+                day TEXT,
+                angel_type TEXT,
+                message_text TEXT,
+                response_method TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (day, angel_type)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_delivery_shards (
+                day TEXT,
+                angel_type TEXT,
+                shard_count INTEGER,
+                shard INTEGER,
+                last_user_id INTEGER DEFAULT 0,
+                sent_count INTEGER DEFAULT 0,
+                completed BOOLEAN DEFAULT FALSE,
+                PRIMARY KEY (day, angel_type, shard_count, shard)
+            )
+        ''')
+
+        # Colonne aggiunte dopo la prima versione dello schema
+        self._add_column(cursor, 'users', 'daily_angel', 'TEXT')
+        self._add_column(cursor, 'users', 'selected_angel', 'TEXT')
+        self._add_column(cursor, 'users', 'changing_info', 'BOOLEAN DEFAULT FALSE')
+        self._add_column(cursor, 'question_log', 'response_policy', 'TEXT')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_daily_angel ON users (daily_angel, user_id)")
+
         conn.commit()
         conn.close()
-    
+
+    def _add_column(self, cursor, table, column, definition):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
     def get_or_create_user(self, user_id, username=None, first_name=None):
-        conn = sqlite3.connect(self.db_path)
+        user = self._fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        if user:
+            return user
+
+        conn = self._connect()
         cursor = conn.cursor()
-        
+
+        cursor.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+            (user_id, username, first_name)
+        )
+        conn.commit()
         cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         user = cursor.fetchone()
         
-        if not user:
-            cursor.execute(
-                "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
-                (user_id, username, first_name)
-            )
-            conn.commit()
-            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            user = cursor.fetchone()
-        
         conn.close()
         return user
     
     def update_user_info(self, user_id, name, birth_date):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute(
@@ -383,33 +1461,31 @@ class DatabaseManager:
         conn.commit()
         conn.close()
     
-    def has_completed_setup(self, user_id):
-        conn = sqlite3.connect(self.db_path)
+    def create_replay_users(self, user_ids, name, birth_date, angel_type):
+        """Utenti già configurati prima dell'inizio della registrazione"""
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT has_completed_setup FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO users (user_id, user_name, birth_date, has_completed_setup, selected_angel) VALUES (?, ?, ?, TRUE, ?)",
+            [(user_id, name, birth_date.isoformat(), angel_type) for user_id in user_ids]
+        )
+        
+        conn.commit()
         conn.close()
+    
+    def has_completed_setup(self, user_id):
+        result = self._fetchone("SELECT has_completed_setup FROM users WHERE user_id = ?", (user_id,))
         
         return result and result[0]
     
     def get_user_info(self, user_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT user_name, birth_date FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = self._fetchone("SELECT user_name, birth_date FROM users WHERE user_id = ?", (user_id,))
         
         return result
     
-    def can_ask_question(self, user_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT subscription_type, questions_used, subscription_expires FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+    def can_ask_question(self, user_id):
+        result = self._fetchone("SELECT subscription_type, questions_used, subscription_expires FROM users WHERE user_id = ?", (user_id,))
         
         if not result:
             return False
@@ -429,50 +1505,44 @@ class DatabaseManager:
         return True
     
     def check_cooldown(self, user_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT subscription_type, last_question_time FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = self._fetchone("SELECT subscription_type, last_question_time FROM users WHERE user_id = ?", (user_id,))
         
         if not result or not result[1]:
             return True
         
         sub_type, last_time = result
-        cooldown_minutes = SUBSCRIPTIONS.get(sub_type, SUBSCRIPTIONS['free'])['cooldown']
+        cooldown = self._cooldown(sub_type)
         
         try:
             last_question = datetime.fromisoformat(last_time)
             time_passed = datetime.now() - last_question
-            return time_passed >= timedelta(minutes=cooldown_minutes)
+            return time_passed >= cooldown
         except ValueError:
             return True
     
     def get_time_until_next_question(self, user_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT subscription_type, last_question_time FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = self._fetchone("SELECT subscription_type, last_question_time FROM users WHERE user_id = ?", (user_id,))
         
         if not result or not result[1]:
             return 0
         
         sub_type, last_time = result
-        cooldown_minutes = SUBSCRIPTIONS.get(sub_type, SUBSCRIPTIONS['free'])['cooldown']
+        cooldown = self._cooldown(sub_type)
         
         try:
             last_question = datetime.fromisoformat(last_time)
             time_passed = datetime.now() - last_question
-            remaining = timedelta(minutes=cooldown_minutes) - time_passed
+            remaining = cooldown - time_passed
             return max(0, int(remaining.total_seconds() / 60))
         except ValueError:
             return 0
     
-    def log_question(self, user_id, angel_type, question_text, response_text, response_method):
-        conn = sqlite3.connect(self.db_path)
+    def _cooldown(self, sub_type):
+        cooldown_minutes = SUBSCRIPTIONS.get(sub_type, SUBSCRIPTIONS['free'])['cooldown']
+        return timedelta(minutes=cooldown_minutes) * self.cooldown_scale
+    
+    def log_question(self, user_id, angel_type, question_text, response_text, response_method, response_policy=None):
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute(
@@ -481,15 +1551,15 @@ class DatabaseManager:
         )
         
         cursor.execute(
-            "INSERT INTO question_log (user_id, angel_type, question_text, response_text, response_method) VALUES (?, ?, ?, ?, ?)",
-            (user_id, angel_type, question_text[:200], response_text[:300], response_method)
+            "INSERT INTO question_log (user_id, angel_type, question_text, response_text, response_method, response_policy) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, angel_type, question_text[:200], response_text[:300], response_method, response_policy)
         )
         
         conn.commit()
         conn.close()
     
     def update_subscription(self, user_id, sub_type, months=0):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         expires = None
@@ -500,13 +1570,298 @@ class DatabaseManager:
             "UPDATE users SET subscription_type = ?, subscription_expires = ?, questions_used = 0 WHERE user_id = ?",
             (sub_type, expires, user_id)
         )
-        
+
+        conn.commit()
+        conn.close()
+
+    def get_subscription_type(self, user_id):
+        result = self._fetchone("SELECT subscription_type FROM users WHERE user_id = ?", (user_id,))
+
+        return result[0] if result else 'free'
+
+    def get_user_status(self, user_id):
+        return self._fetchone("SELECT subscription_type, questions_used, user_name FROM users WHERE user_id = ?", (user_id,))
+
+    def get_session_state(self, user_id):
+        result = self._fetchone("SELECT selected_angel, changing_info FROM users WHERE user_id = ?", (user_id,))
+
+        return result
+
+    def save_session_state(self, user_id, selected_angel, changing_info):
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute(
+            "UPDATE users SET selected_angel = ?, changing_info = ? WHERE user_id = ?",
+            (selected_angel, changing_info, user_id)
+        )
+
+        conn.commit()
+        conn.close()
+
+    def get_recent_ai_answers(self, angel_type, limit):
+        result = self._fetchall(
+            '''SELECT q.id, q.angel_type, q.question_text, q.response_text, u.user_name, u.first_name
+               FROM question_log q LEFT JOIN users u ON u.user_id = q.user_id
+               WHERE q.response_method = 'ai' AND q.angel_type = ? ORDER BY q.id DESC LIMIT ?''',
+            (angel_type, limit)
+        )
+
+        result.reverse()
+        return result
+
+    def get_ai_answers_after(self, after_id, limit):
+        result = self._fetchall(
+            '''SELECT q.id, q.angel_type, q.question_text, q.response_text, u.user_name, u.first_name
+               FROM question_log q LEFT JOIN users u ON u.user_id = q.user_id
+               WHERE q.response_method = 'ai' AND q.id > ? ORDER BY q.id LIMIT ?''',
+            (after_id, limit)
+        )
+
+        return result
+
+    def set_daily_angel(self, user_id, angel_type):
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute("UPDATE users SET daily_angel = ? WHERE user_id = ?", (angel_type, user_id))
+
+        conn.commit()
+        conn.close()
+
+    def get_daily_angel(self, user_id):
+        result = self._fetchone("SELECT daily_angel FROM users WHERE user_id = ?", (user_id,))
+
+        return result[0] if result else None
+
+    def get_daily_recipients(self, angel_type, after_user_id, limit, shard=0, shard_count=1):
+        """Pagina keyset degli iscritti del proprio shard (user_id % shard_count): mai OFFSET, mai tutta la tabella in memoria"""
+        rows = self._fetchall(
+            "SELECT user_id FROM users WHERE daily_angel = ? AND user_id > ? AND user_id % ? = ? ORDER BY user_id LIMIT ?",
+            (angel_type, after_user_id, shard_count, shard, limit)
+        )
+
+        return [row[0] for row in rows]
+
+    def get_daily_message(self, day, angel_type):
+        result = self._fetchone("SELECT message_text FROM daily_messages WHERE day = ? AND angel_type = ?", (day, angel_type))
+
+        return result[0] if result else None
+
+    def save_daily_message(self, day, angel_type, message_text, response_method):
+        """Salva il messaggio del giorno; se esiste già vince quello salvato per primo"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute(
+            "INSERT OR IGNORE INTO daily_messages (day, angel_type, message_text, response_method) VALUES (?, ?, ?, ?)",
+            (day, angel_type, message_text, response_method)
+        )
+        conn.commit()
+
+        cursor.execute("SELECT message_text FROM daily_messages WHERE day = ? AND angel_type = ?", (day, angel_type))
+        result = cursor.fetchone()
+        conn.close()
+
+        return result[0]
+
+    def get_daily_checkpoint(self, day, angel_type, shard=0, shard_count=1):
+        result = self._fetchone(
+            "SELECT last_user_id, sent_count, completed FROM daily_delivery_shards WHERE day = ? AND angel_type = ? AND shard_count = ? AND shard = ?",
+            (day, angel_type, shard_count, shard)
+        )
+
+        if not result:
+            return 0, 0, False
+
+        last_user_id, sent_count, completed = result
+        return last_user_id, sent_count, bool(completed)
+
+    def save_daily_checkpoint(self, day, angel_type, last_user_id, sent_count, completed=False, shard=0, shard_count=1):
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute(
+            '''INSERT INTO daily_delivery_shards (day, angel_type, shard_count, shard, last_user_id, sent_count, completed)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (day, angel_type, shard_count, shard) DO UPDATE SET
+                   last_user_id = excluded.last_user_id,
+                   sent_count = excluded.sent_count,
+                   completed = excluded.completed''',
+            (day, angel_type, shard_count, shard, last_user_id, sent_count, completed)
+        )
+
         conn.commit()
         conn.close()
 
+class UserSession:
+    __slots__ = ('user_id', 'selected_angel', 'changing_info', 'last_seen')
+
+    def __init__(self, user_id, selected_angel=None, changing_info=False):
+        self.user_id = user_id
+        self.selected_angel = selected_angel
+        self.changing_info = changing_info
+        self.last_seen = time.monotonic()
+
+class SessionStore:
+    """Stato di conversazione per utente, al posto di context.user_data.
+
+    Le modifiche vengono scritte subito nella tabella users; in memoria
+    restano solo gli utenti attivi negli ultimi `idle_ttl` secondi, in ordine
+    di ultimo accesso, così la pulizia scorre solo le sessioni scadute.
+    """
+    def __init__(self, db, idle_ttl):
+        self.db = db
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self.stats = {'restored': 0, 'evicted': 0}
+
+    def get(self, user_id) -> UserSession:
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self._sessions.move_to_end(user_id)
+            session.last_seen = time.monotonic()
+            return session
+
+        state = self.db.get_session_state(user_id)
+        if state:
+            session = UserSession(user_id, state[0], bool(state[1]))
+            self.stats['restored'] += 1
+        else:
+            session = UserSession(user_id)
+        self._sessions[user_id] = session
+        return session
+
+    def set_selected_angel(self, user_id, angel_type):
+        session = self.get(user_id)
+        session.selected_angel = angel_type
+        self.db.save_session_state(user_id, session.selected_angel, session.changing_info)
+
+    def set_changing_info(self, user_id, changing_info):
+        session = self.get(user_id)
+        if session.changing_info == changing_info:
+            return
+        session.changing_info = changing_info
+        self.db.save_session_state(user_id, session.selected_angel, session.changing_info)
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.last_seen > cutoff:
+                break
+            del self._sessions[user_id]
+            evicted += 1
+
+        self.stats['evicted'] += evicted
+        return evicted
+
+    def metrics(self) -> dict:
+        approx_bytes = sys.getsizeof(self._sessions)
+        approx_bytes += sum(sys.getsizeof(session) for session in self._sessions.values())
+        return {'resident': len(self._sessions), 'approx_bytes': approx_bytes, **self.stats}
+
+class TrafficRecorder:
+    """Scrive gli aggiornamenti in arrivo in un file JSON lines append-only, per il replay.
+
+    Niente dati personali: l'id utente diventa un HMAC con `salt`, i testi
+    liberi vengono ridotti a tipo e lunghezza. Restano i dati dei bottoni
+    (sono nostri) e il piano dei pagamenti.
+    """
+    _BIRTH_INFO_PATTERN = re.compile(r'\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4}\s*$')
+
+    def __init__(self, path, salt=None):
+        self.path = path
+        self._salt = (salt or os.urandom(16).hex()).encode()
+        self._file = open(path, 'a', encoding='utf-8')
+        self.recorded = 0
+
+    def _anonymize(self, user_id):
+        digest = hmac.new(self._salt, str(user_id).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:6], 'big')
+
+    async def handle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        record = self._to_record(update)
+        if record:
+            self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self._file.flush()
+            self.recorded += 1
+
+    def _to_record(self, update):
+        if not update.effective_user:
+            return None
+        record = {'ts': round(time.time(), 3), 'u': self._anonymize(update.effective_user.id)}
+
+        if update.callback_query:
+            record.update(k='callback', d=update.callback_query.data)
+        elif update.pre_checkout_query:
+            record.update(k='pre_checkout', d=update.pre_checkout_query.invoice_payload)
+        elif update.message and update.message.successful_payment:
+            record.update(k='payment', d=update.message.successful_payment.invoice_payload)
+        elif update.message and update.message.text:
+            text = update.message.text
+            if text.startswith('/'):
+                record.update(k='command', d=text.split()[0])
+            elif self._BIRTH_INFO_PATTERN.search(text):
+                record.update(k='setup', n=len(text))
+            else:
+                record.update(k='text', n=len(text))
+        else:
+            return None
+
+        return record
+
+    def close(self):
+        self._file.close()
+
+class ReplayRequest(BaseRequest):
+    """Bot API finta per il replay: ogni chiamata riesce dopo `latency` secondi"""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Angels Oracle', 'username': 'angels_oracle_bot'}
+        elif endpoint.startswith('send') or endpoint == 'editMessageText':
+            self._message_id += 1
+            result = {
+                'message_id': self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        else:
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
 # Initialize systems
-db = DatabaseManager(DATABASE_PATH)
-ai_system = AngelAISystem(OPENAI_API_KEY)
+db = DatabaseManager(DATABASE_PATH, SQLITE_READ_POOL_SIZE)
+sessions = SessionStore(db, SESSION_IDLE_TTL)
+answer_index = AnswerIndex(ANSWER_INDEX_MAX_DOCS)
+loop_watchdog = LoopLagWatchdog(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD, LOOP_LAG_METRICS_INTERVAL)
+ai_system = AngelAISystem(
+    OPENAI_API_KEY, OPENAI_BATCH_WINDOW_MS, OPENAI_BATCH_MAX_SIZE, answer_index=answer_index,
+    budget=ResponseBudgetController(RESPONSE_POLICY, OPENAI_FAST_MODEL, OPENAI_LATENCY_TARGET)
+)
 
 async def start_payment(update, context, plan_type):
     """Avvia il processo di pagamento"""
@@ -599,6 +1954,7 @@ Disclaimer: This is for entertainment purposes only."""
         [InlineKeyboardButton("Angel of Darkness", callback_data='angel_dark')],
         [InlineKeyboardButton("Premium Plans", callback_data='premium')],
         [InlineKeyboardButton("My Status", callback_data='status')],
+        [InlineKeyboardButton("Daily Message", callback_data='daily_guidance')],
         [InlineKeyboardButton("Change My Info", callback_data='change_info')]
     ]
     
@@ -619,15 +1975,18 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == 'how_it_works':
         await show_how_it_works(query)
     elif data == 'change_info':
-        context.user_data['changing_info'] = True
+        sessions.set_changing_info(user_id, True)
         await show_change_info_screen(query)
     elif data == 'back_to_setup':
         await show_setup_screen(query)
     elif data == 'back_main':
+        # Uscire dal menu (anche con Cancel) chiude il cambio dati rimasto aperto
+        sessions.set_changing_info(user_id, False)
         await show_main_menu(query)
     elif data.startswith('angel_'):
         angel_type = 'light' if data == 'angel_light' else 'dark'
-        context.user_data['selected_angel'] = angel_type
+        sessions.set_changing_info(user_id, False)
+        sessions.set_selected_angel(user_id, angel_type)
         await show_angel_intro(query, angel_type)
     elif data == 'premium':
         await show_premium_plans(query)
@@ -637,6 +1996,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await start_payment(query, context, 'premium_6m')
     elif data == 'buy_premium_12m':
         await start_payment(query, context, 'premium_12m')
+    elif data == 'daily_guidance':
+        await show_daily_guidance_screen(query, user_id)
+    elif data in ('daily_light', 'daily_dark', 'daily_off'):
+        db.set_daily_angel(user_id, None if data == 'daily_off' else data[len('daily_'):])
+        await show_daily_guidance_screen(query, user_id)
 
 async def show_how_it_works(query):
     text = """How Angels Oracle Works
@@ -735,12 +2099,7 @@ Payments are secure and processed by Telegram"""
     await query.edit_message_text(text, reply_markup=reply_markup)
 
 async def show_user_status(query, user_id):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT subscription_type, questions_used, user_name FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    result = db.get_user_status(user_id)
     
     if not result:
         await query.edit_message_text("User not found. Please use /start")
@@ -771,12 +2130,40 @@ Cooldown: {sub_info['cooldown']} minutes"""
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(status_text, reply_markup=reply_markup)
 
+async def show_daily_guidance_screen(query, user_id):
+    daily_angel = db.get_daily_angel(user_id)
+
+    if daily_angel == 'light':
+        current = "Seraphiel (Light)"
+    elif daily_angel == 'dark':
+        current = "Nyxareth (Darkness)"
+    else:
+        current = "Off"
+
+    text = f"""Daily Message
+
+Receive one message from your angel every day at {DAILY_GUIDANCE_HOUR:02d}:00.
+Daily messages do not count towards your question limit.
+
+Current choice: {current}"""
+
+    keyboard = [
+        [InlineKeyboardButton("Daily from Seraphiel", callback_data='daily_light')],
+        [InlineKeyboardButton("Daily from Nyxareth", callback_data='daily_dark')],
+        [InlineKeyboardButton("Turn Off", callback_data='daily_off')],
+        [InlineKeyboardButton("Back", callback_data='back_main')]
+    ]
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
+    session = sessions.get(user_id)
     
     # Solo se l'utente non ha completato setup O sta deliberatamente cambiando info
-    if (not db.has_completed_setup(user_id)) or context.user_data.get('changing_info', False):
+    if (not db.has_completed_setup(user_id)) or session.changing_info:
         is_valid, error_msg, name, birth_date = validate_birth_info(text)
         
         if not is_valid:
@@ -785,8 +2172,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         db.update_user_info(user_id, name, birth_date)
         
-        if context.user_data.get('changing_info', False):
-            context.user_data['changing_info'] = False
+        if session.changing_info:
+            sessions.set_changing_info(user_id, False)
             await update.message.reply_text(f"Your information has been updated successfully, {name}!")
             await show_main_menu(update)
         else:
@@ -794,7 +2181,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_main_menu(update)
         return
     
-    if 'selected_angel' not in context.user_data:
+    if session.selected_angel is None:
         keyboard = [
             [InlineKeyboardButton("Angel of Light", callback_data='angel_light')],
             [InlineKeyboardButton("Angel of Darkness", callback_data='angel_dark')]
@@ -806,7 +2193,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    angel_type = context.user_data['selected_angel']
+    angel_type = session.selected_angel
     
     # Check question limits
     if not db.can_ask_question(user_id):
@@ -839,10 +2226,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_name, birth_date_str = user_info
     
     # Generate AI response
-    response_data = await ai_system.generate_response(angel_type, text, user_name, birth_date_str)
+    tier = db.get_subscription_type(user_id)
+    response_data = await ai_system.generate_response(angel_type, text, user_name, birth_date_str, tier)
     
     # Log the question and response
-    db.log_question(user_id, angel_type, text, response_data['response'], response_data['method'])
+    db.log_question(user_id, angel_type, text, response_data['response'], response_data['method'], response_data.get('policy'))
     
     # Send response
     angel_name = "Seraphiel" if angel_type == 'light' else "Nyxareth"
@@ -899,7 +2287,559 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+async def deliver_daily_guidance(bot, day, shard=0, shard_count=1):
+    """Genera un messaggio per angelo e lo invia agli iscritti del proprio shard, riprendendo dal checkpoint.
+
+    Con più processi ognuno invia a `user_id % shard_count == shard` con una quota
+    di DAILY_GUIDANCE_RATE: insieme mantengono la velocità totale di un processo solo.
+    """
+    limiter = AsyncRateLimiter(DAILY_GUIDANCE_RATE / shard_count)
+    for angel_type in ('light', 'dark'):
+        await deliver_daily_guidance_for_angel(bot, day, angel_type, limiter, shard, shard_count)
+
+async def deliver_daily_guidance_for_angel(bot, day, angel_type, limiter, shard=0, shard_count=1):
+    last_user_id, sent_count, completed = db.get_daily_checkpoint(day, angel_type, shard, shard_count)
+    if completed:
+        return
+
+    if not db.get_daily_recipients(angel_type, last_user_id, 1, shard, shard_count):
+        db.save_daily_checkpoint(day, angel_type, last_user_id, sent_count, True, shard, shard_count)
+        return
+
+    # Una sola chiamata AI al giorno per angelo, qualunque sia il numero di iscritti;
+    # se più shard la fanno insieme, il primo messaggio salvato vale per tutti
+    message_text = db.get_daily_message(day, angel_type)
+    if message_text is None:
+        response_data = await ai_system.generate_daily_message(angel_type)
+        message_text = db.save_daily_message(day, angel_type, response_data['response'], response_data['method'])
+
+    angel_name = "Seraphiel" if angel_type == 'light' else "Nyxareth"
+    # Il testo viene dall'AI: un solo '_' o '*' non escapato farebbe fallire ogni invio
+    formatted_message = f"*{escape_markdown(message_text, version=2)}*\n\n{escape_markdown(f'- {angel_name}', version=2)}"
+    reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Stop Daily Messages", callback_data='daily_off')]
+    ])
+
+    logger.info(f"Daily guidance {day}/{angel_type} shard {shard}/{shard_count}: resuming after user {last_user_id} ({sent_count} already sent)")
+
+    since_checkpoint = 0
+    try:
+        while True:
+            recipients = db.get_daily_recipients(angel_type, last_user_id, DAILY_GUIDANCE_PAGE_SIZE, shard, shard_count)
+            if not recipients:
+                break
+
+            for user_id in recipients:
+                await limiter.acquire()
+                if await send_daily_message(bot, user_id, formatted_message, reply_markup):
+                    sent_count += 1
+                last_user_id = user_id
+                since_checkpoint += 1
+
+                if since_checkpoint >= DAILY_GUIDANCE_CHECKPOINT_EVERY:
+                    db.save_daily_checkpoint(day, angel_type, last_user_id, sent_count, False, shard, shard_count)
+                    since_checkpoint = 0
+
+        completed = True
+    finally:
+        db.save_daily_checkpoint(day, angel_type, last_user_id, sent_count, completed, shard, shard_count)
+
+    logger.info(f"Daily guidance {day}/{angel_type} shard {shard}/{shard_count}: delivered to {sent_count} users")
+
+async def send_daily_message(bot, user_id, text, reply_markup):
+    """Invia il messaggio a un utente; False se l'utente va saltato.
+
+    I 429 vengono ritentati da OutboundDispatcher: un RetryAfter che arriva fin
+    qui, come un BadRequest sul messaggio, vale per tutti gli utenti e ferma
+    l'invio senza far avanzare il checkpoint.
+    """
+    try:
+        await bot.send_message(chat_id=user_id, text=text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=reply_markup)
+        return True
+    except Forbidden:
+        # L'utente ha bloccato il bot: niente più messaggi giornalieri
+        db.set_daily_angel(user_id, None)
+        return False
+    except BadRequest as e:
+        if 'chat not found' not in e.message.lower():
+            raise
+        db.set_daily_angel(user_id, None)
+        return False
+    except RetryAfter:
+        raise
+    except TelegramError as e:
+        logger.warning(f"Could not send daily guidance to {user_id}: {e}")
+        return False
+
+async def daily_guidance_loop(application):
+    shard = application.bot_data.get('worker_id', 0)
+    shard_count = application.bot_data.get('worker_count', 1)
+    while True:
+        now = datetime.now()
+        run_at = now.replace(hour=DAILY_GUIDANCE_HOUR, minute=0, second=0, microsecond=0)
+
+        if now >= run_at:
+            try:
+                await deliver_daily_guidance(application.bot, now.date().isoformat(), shard, shard_count)
+                run_at += timedelta(days=1)
+            except Exception as e:
+                # Il checkpoint è fermo all'ultimo invio riuscito: si riprende da lì
+                logger.error(f"Daily guidance delivery failed, retrying in {DAILY_GUIDANCE_RETRY_SECONDS}s: {e}")
+                run_at = datetime.now() + timedelta(seconds=DAILY_GUIDANCE_RETRY_SECONDS)
+
+        await asyncio.sleep(max(1, (run_at - datetime.now()).total_seconds()))
+
+def mentions_person(text, *names):
+    """True se il testo contiene il nome (o una parte del nome) di chi ha fatto la domanda"""
+    for name in names:
+        if not name:
+            continue
+        for part in [name] + name.split():
+            if len(part) >= 2 and re.search(rf'\b{re.escape(part)}\b', text, re.IGNORECASE):
+                return True
+    return False
+
+async def refresh_answer_index():
+    # Query in un thread e indicizzazione a blocchi: il primo caricamento non ferma l'event loop
+    if not answer_index.last_log_id:
+        # Primo caricamento: solo le risposte più recenti di ogni angelo
+        for angel_type in ('light', 'dark'):
+            await index_answer_rows(await asyncio.to_thread(db.get_recent_ai_answers, angel_type, answer_index.max_docs))
+        return
+
+    while True:
+        rows = await asyncio.to_thread(db.get_ai_answers_after, answer_index.last_log_id, 1000)
+        await index_answer_rows(rows)
+        if len(rows) < 1000:
+            return
+
+async def index_answer_rows(rows):
+    for start in range(0, len(rows), ANSWER_INDEX_CHUNK_SIZE):
+        # Le risposte AI sono scritte per una persona: quelle che la nominano non vanno mostrate ad altri
+        for log_id, angel_type, question_text, response_text, user_name, first_name in rows[start:start + ANSWER_INDEX_CHUNK_SIZE]:
+            if not mentions_person(response_text, user_name, first_name):
+                answer_index.add(angel_type, question_text, response_text)
+            answer_index.last_log_id = max(answer_index.last_log_id, log_id)
+        await asyncio.sleep(0)
+
+async def answer_index_loop():
+    while True:
+        try:
+            await refresh_answer_index()
+        except Exception as e:
+            logger.error(f"Answer index refresh failed: {e}")
+        await asyncio.sleep(ANSWER_INDEX_REFRESH_SECONDS)
+
+async def metrics_loop(application):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        logger.info(f"OpenAI circuit: {ai_system.circuit_breaker.metrics()}")
+        logger.info(f"Response budget: {ai_system.budget.metrics()}")
+        if ai_system.batcher:
+            logger.info(f"OpenAI batcher: {ai_system.batcher.metrics()}")
+        logger.info(f"Update processor: {application.update_processor.metrics()}")
+        logger.info(f"Answer index: {answer_index.metrics()}")
+        logger.info(f"Sessions: {sessions.metrics()}")
+
+async def session_eviction_loop():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+        evicted = sessions.evict_idle()
+        if evicted:
+            logger.info(f"Sessions: evicted {evicted} idle")
+
+async def post_init(application):
+    application.bot_data['background_tasks'] = [
+        asyncio.create_task(answer_index_loop()),
+        asyncio.create_task(session_eviction_loop())
+    ]
+
+    if METRICS_INTERVAL > 0:
+        application.bot_data['background_tasks'].append(asyncio.create_task(metrics_loop(application)))
+
+    # Ogni processo invia il messaggio giornaliero agli utenti del proprio shard
+    application.bot_data['background_tasks'].append(asyncio.create_task(daily_guidance_loop(application)))
+
+    if loop_watchdog.enabled:
+        application.bot_data['background_tasks'].append(loop_watchdog.start())
+
+async def post_shutdown(application):
+    loop_watchdog.stop()
+    for task in application.bot_data.get('background_tasks', []):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    recorder = application.bot_data.get('traffic_recorder')
+    if recorder:
+        recorder.close()
+        logger.info(f"Traffic capture: {recorder.recorded} updates written to {recorder.path}")
+
+def build_application(global_rate, polling=True, token=None, request=None, capture_path=None):
+    outbound = OutboundDispatcher(
+        global_rate, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+        OUTBOUND_MAX_RETRIES, OUTBOUND_METRICS_INTERVAL
+    )
+
+    builder = (
+        Application.builder()
+        .token(token or BOT_TOKEN)
+        .rate_limiter(outbound)
+        .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING, loop_watchdog))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)
+    if request:
+        builder = builder.request(request)
+    application = builder.build()
+
+    if capture_path:
+        # Gruppo -1: registra ogni aggiornamento senza togliere nulla agli handler normali
+        recorder = TrafficRecorder(capture_path, TRAFFIC_CAPTURE_SALT)
+        application.bot_data['traffic_recorder'] = recorder
+        application.add_handler(TypeHandler(Update, recorder.handle), group=-1)
+        logger.info(f"Traffic capture enabled: {capture_path}")
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+
+    return application
+
+def shard_for_update(update, shard_count):
+    """Stesso utente, stesso processo: stato e ordine degli aggiornamenti restano locali"""
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = 0
+    return key % shard_count
+
+def run_worker(worker_id, worker_count, inbound, supervisor_pid):
+    # Lo spegnimento arriva dal supervisore tramite la coda, non dai segnali
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(serve_worker(worker_id, worker_count, inbound, supervisor_pid))
+
+async def serve_worker(worker_id, worker_count, inbound, supervisor_pid):
+    # Il limite globale di Telegram vale per il bot intero: ogni processo ne usa una quota
+    capture_path = f"{TRAFFIC_CAPTURE_PATH}.{worker_id}" if TRAFFIC_CAPTURE_PATH else None
+    application = build_application(OUTBOUND_GLOBAL_RATE / worker_count, polling=False, capture_path=capture_path)
+    application.bot_data['worker_id'] = worker_id
+    application.bot_data['worker_count'] = worker_count
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    logger.info(f"Worker {worker_id}/{worker_count} ready")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, inbound.get, True, 1.0)
+            except queue.Empty:
+                if os.getppid() != supervisor_pid:
+                    logger.error(f"Worker {worker_id}: supervisor is gone, shutting down")
+                    break
+                continue
+
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+    finally:
+        # stop() elabora gli aggiornamenti ancora in coda prima di fermarsi
+        await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+        logger.info(f"Worker {worker_id} drained and stopped")
+
+async def route_update(data, inbound_queues, shard, revive_workers, stop):
+    """Consegna con attesa limitata: una coda piena non blocca il controllo dei worker né lo spegnimento"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        # Un worker riavviato ha una coda nuova: la si rilegge a ogni tentativo
+        revive_workers()
+        try:
+            await loop.run_in_executor(None, inbound_queues[shard].put, data, True, 1.0)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+async def poll_and_route(inbound_queues, revive_workers):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+
+        while not stop.is_set():
+            revive_workers()
+            poll = asyncio.create_task(bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES))
+            stopping = asyncio.create_task(stop.wait())
+            await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+
+            if not poll.done():
+                poll.cancel()
+                break
+
+            try:
+                updates = poll.result()
+            except TelegramError as e:
+                logger.warning(f"Polling failed: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                shard = shard_for_update(update, len(inbound_queues))
+                # Coda piena = processo lento: il supervisore aspetta invece di accumulare
+                if not await route_update(update.to_json(), inbound_queues, shard, revive_workers, stop):
+                    break
+                offset = update.update_id + 1
+
+def salvage_queue(inbound):
+    """Svuota la coda di un worker morto e restituisce gli aggiornamenti non ancora letti.
+
+    Un worker ucciso dentro get() (kill -9, OOM) lascia preso il lock di lettura
+    condiviso: la coda non è più utilizzabile e va sostituita. Il worker era
+    l'unico lettore, quindi il lock si può liberare per recuperare il contenuto.
+    """
+    try:
+        inbound._rlock.release()
+    except ValueError:
+        pass
+
+    items = []
+    while True:
+        try:
+            data = inbound.get(True, 0.2)
+        except queue.Empty:
+            break
+        except Exception as e:
+            # Ucciso a metà di una lettura: il resto della pipe non è più leggibile
+            logger.error(f"Could not read the rest of a dead worker's queue: {e}")
+            break
+        if isinstance(data, str):
+            items.append(data)
+
+    inbound.cancel_join_thread()
+    inbound.close()
+    return items
+
+def run_supervisor(worker_count):
+    context = multiprocessing.get_context('spawn')
+    inbound_queues = [context.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(worker_count)]
+
+    def start_worker(worker_id):
+        worker = context.Process(
+            target=run_worker,
+            args=(worker_id, worker_count, inbound_queues[worker_id], os.getpid()),
+            name=f"angels-worker-{worker_id}"
+        )
+        worker.start()
+        return worker
+
+    def revive_workers():
+        # Un worker morto riparte su una coda nuova con gli aggiornamenti rimasti in quella vecchia
+        for worker_id, worker in enumerate(workers):
+            if worker.is_alive():
+                continue
+            logger.error(f"{worker.name} died with exit code {worker.exitcode}, restarting")
+            leftover = salvage_queue(inbound_queues[worker_id])
+            inbound_queues[worker_id] = context.Queue(maxsize=WORKER_QUEUE_SIZE)
+            for data in leftover:
+                inbound_queues[worker_id].put_nowait(data)
+            if leftover:
+                logger.info(f"{worker.name}: re-routed {len(leftover)} queued updates to its replacement")
+            workers[worker_id] = start_worker(worker_id)
+
+    workers = [start_worker(worker_id) for worker_id in range(worker_count)]
+    logger.info(f"Supervisor started {worker_count} worker processes")
+
+    try:
+        asyncio.run(poll_and_route(inbound_queues, revive_workers))
+    finally:
+        logger.info("Supervisor stopping, draining workers...")
+        for inbound in inbound_queues:
+            try:
+                inbound.put(None, timeout=WORKER_DRAIN_SECONDS)
+            except queue.Full:
+                pass
+        for worker in workers:
+            worker.join(WORKER_DRAIN_SECONDS)
+            if worker.is_alive():
+                logger.warning(f"{worker.name} did not drain in time, terminating")
+                worker.terminate()
+
+REPLAY_WORDS = ['will', 'my', 'path', 'love', 'find', 'soon', 'work', 'family', 'change', 'heart', 'future', 'friend', 'what', 'should', 'know']
+
+def load_capture(paths):
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as capture:
+            records.extend(json.loads(line) for line in capture if line.strip())
+    records.sort(key=lambda record: record['ts'])
+    return records
+
+def replay_update(record, update_id):
+    """Ricostruisce un aggiornamento Telegram plausibile da una riga registrata"""
+    now = int(time.time())
+    user = {'id': record['u'], 'is_bot': False, 'first_name': 'Replay'}
+    chat = {'id': record['u'], 'type': 'private'}
+    kind = record['k']
+
+    if kind == 'callback':
+        bot_message = {'message_id': update_id, 'date': now, 'chat': chat, 'text': 'menu'}
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': 'replay', 'data': record['d'], 'message': bot_message
+        }}
+    if kind == 'pre_checkout':
+        return {'update_id': update_id, 'pre_checkout_query': {
+            'id': str(update_id), 'from': user, 'currency': 'EUR',
+            'total_amount': SUBSCRIPTIONS.get(record['d'], SUBSCRIPTIONS['free'])['price'], 'invoice_payload': record['d']
+        }}
+
+    message = {'message_id': update_id, 'date': now, 'chat': chat, 'from': user}
+    if kind == 'payment':
+        message['successful_payment'] = {
+            'currency': 'EUR', 'total_amount': SUBSCRIPTIONS.get(record['d'], SUBSCRIPTIONS['free'])['price'],
+            'invoice_payload': record['d'], 'telegram_payment_charge_id': 'replay', 'provider_payment_charge_id': 'replay'
+        }
+    elif kind == 'command':
+        message['text'] = record['d']
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(record['d'])}]
+    elif kind == 'setup':
+        message['text'] = 'Replay 15/03/1990'
+    else:
+        words = []
+        while len(' '.join(words)) < record.get('n', 20):
+            words.append(random.choice(REPLAY_WORDS))
+        message['text'] = ' '.join(words) + '?'
+
+    return {'update_id': update_id, 'message': message}
+
+async def replay_openai(url, headers, data):
+    await asyncio.sleep(replay_openai.latency)
+    prompt = data['messages'][-1]['content']
+    batch_size = re.search(r'JSON array of exactly (\d+) strings', prompt)
+    if batch_size:
+        return json.dumps([random.choice(ai_system.fallback_responses['light']) for _ in range(int(batch_size.group(1)))])
+    return random.choice(ai_system.fallback_responses['light'])
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def replay_preconfigured_users(records):
+    """Utenti che nella registrazione fanno domande senza passare prima dal setup"""
+    first_message = {}
+    for record in records:
+        if record['k'] in ('setup', 'text'):
+            first_message.setdefault(record['u'], record['k'])
+    return {record['u'] for record in records if first_message.get(record['u']) != 'setup'}
+
+async def replay_capture(paths, speed, telegram_latency, openai_latency):
+    global db
+    records = load_capture(paths)
+    if not records:
+        logger.error("Nothing to replay")
+        return
+
+    # Database usa e getta e OpenAI finto: il replay non tocca dati né servizi reali
+    scratch_dir = tempfile.mkdtemp(prefix='angels_replay_')
+    try:
+        db = DatabaseManager(os.path.join(scratch_dir, 'replay.db'), SQLITE_READ_POOL_SIZE)
+        try:
+            await _replay_records(records, paths, speed, telegram_latency, openai_latency)
+        finally:
+            db.close()
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+async def _replay_records(records, paths, speed, telegram_latency, openai_latency):
+    sessions.db = db
+    db.cooldown_scale = 0.0 if speed == 'max' else 1.0 / speed
+    db.create_replay_users(replay_preconfigured_users(records), 'Replay', datetime(1990, 3, 15), 'light')
+    ai_system.api_key = ai_system.api_key or 'replay'
+    replay_openai.latency = openai_latency
+    ai_system._post_openai = replay_openai
+
+    request = ReplayRequest(telegram_latency)
+    application = build_application(OUTBOUND_GLOBAL_RATE, polling=False, token='0:replay', request=request)
+    latencies = {}
+
+    async def feed(record, update_id, delay):
+        await asyncio.sleep(delay)
+        update = Update.de_json(replay_update(record, update_id), application.bot)
+        started = time.monotonic()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.setdefault(record['k'], []).append(time.monotonic() - started)
+
+    await application.initialize()
+    await application.start()
+    pace = 'maximum speed' if speed == 'max' else f"{speed:g}x speed"
+    logger.info(f"Replaying {len(records)} updates from {', '.join(paths)} at {pace}")
+
+    started = time.monotonic()
+    first_ts = records[0]['ts']
+    await asyncio.gather(*(
+        feed(record, update_id, 0 if speed == 'max' else (record['ts'] - first_ts) / speed)
+        for update_id, record in enumerate(records, 1)
+    ))
+    elapsed = time.monotonic() - started
+
+    await application.stop()
+    await application.shutdown()
+
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    print(f"Replayed {len(all_latencies)} updates in {elapsed:.1f}s ({len(all_latencies) / elapsed:.1f} updates/s)")
+    for kind, values in sorted(latencies.items()) + [('all', all_latencies)]:
+        print(f"  {kind:<12} n={len(values):<6} p50={percentile(values, 0.5) * 1000:.0f}ms "
+              f"p95={percentile(values, 0.95) * 1000:.0f}ms p99={percentile(values, 0.99) * 1000:.0f}ms "
+              f"max={max(values) * 1000:.0f}ms")
+    print(f"  Bot API calls: {dict(request.calls)}")
+
+def replay_speed(value):
+    if value == 'max':
+        return value
+    try:
+        speed = float(value)
+    except ValueError:
+        speed = 0
+    if not speed > 0:
+        raise argparse.ArgumentTypeError(f"invalid speed {value!r}: use a positive number or 'max'")
+    return speed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Angels Oracle Telegram bot")
+    commands = parser.add_subparsers(dest='command')
+
+    replay = commands.add_parser('replay', help="replay captured traffic against stubbed Telegram and OpenAI")
+    replay.add_argument('captures', nargs='+', help="files written with TRAFFIC_CAPTURE_PATH")
+    replay.add_argument('--speed', type=replay_speed, default=1.0, help="time compression factor (1, 10, ...) or 'max'")
+    replay.add_argument('--telegram-latency', type=float, default=0.05, help="simulated Bot API latency in seconds")
+    replay.add_argument('--openai-latency', type=float, default=0.8, help="simulated OpenAI latency in seconds")
+
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    if args.command == 'replay':
+        asyncio.run(replay_capture(args.captures, args.speed, args.telegram_latency, args.openai_latency))
+        return
+
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN environment variable not set!")
         return
@@ -915,13 +2855,12 @@ def main():
     else:
         logger.warning("Payment token not found - payments disabled")
     
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(handle_callback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+    if WORKER_PROCESSES > 1:
+        logger.info("Angels Oracle AI Bot started successfully!")
+        run_supervisor(WORKER_PROCESSES)
+        return
+
+    application = build_application(OUTBOUND_GLOBAL_RATE, capture_path=TRAFFIC_CAPTURE_PATH)
     
     logger.info("Angels Oracle AI Bot started successfully!")
     application.run_polling(drop_pending_updates=True)